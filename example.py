@@ -81,7 +81,8 @@ class FooObject(object):
     pass
 
 
-with minidb.Store(debug=True) as db:
+# Run all statements in a single transaction instead of one per statement
+with minidb.Store(debug=True) as db, db.transaction():
     db.register(Person)
     db.register(WithoutConstructor)
     db.register(AdvancedPerson)
@@ -93,17 +94,20 @@ with minidb.Store(debug=True) as db:
     for aperson in AdvancedPerson.load(db):
         print(aperson)
 
+    items = []
     for i in range(5):
         w = WithoutConstructor(name='x', age=10 + 3 * i)
         w.height = w.age * 3.33
-        w.save(db)
-        print(w)
+        items.append(w)
         w2 = WithoutConstructor()
         w2.name = 'xx'
         w2.age = 100 + w.age
         w2.height = w2.age * 23.33
-        w2.save(db)
-        print(w2)
+        items.append(w2)
+
+    # Insert all objects at once instead of one INSERT per object
+    for w in db.save_many(WithoutConstructor, items):
+        print(w)
 
     for i in range(3):
         p = Person(FooObject(), username='foo' * i)
@@ -120,15 +124,14 @@ with minidb.Store(debug=True) as db:
 
     print('loader is:', Person.load(db))
 
+    print('delete')
+    # A single DELETE statement instead of loading and deleting each object
+    print('deleted:', Person.delete_where(db, Person.c.username == ''))
+
     print('query')
     # for person in db.load(Person, FooObject()):
     for person in Person.load(db)(FooObject()):
         print(person)
-        if person.username == '':
-            print('delete')
-            person.delete()
-            print('id after delete:', person.id)
-            continue
         person.mail = person.username + '@example.com'
         person.save()
         print(person)
@@ -173,25 +176,25 @@ with minidb.Store(debug=True) as db:
     print(Person.delete_where(db, Person.c.username.length <= 3))
 
     print('what is left')
-    for p in Person.load(db)(FooObject()):
-        uu = next(Person.query(db, minidb.columns(Person.c.username.upper('up'),
-                                                  Person.c.username.lower('down'),
-                                                  Person.c.foo('foox'),
-                                                  Person.c.foo),
-                               where=(Person.c.id == p.id),
-                               order_by=minidb.columns(Person.c.id.desc,
-                                                       Person.c.username.length.asc),
-                               limit=1))
-        print(p.id, p.username, p.mail, uu)
+    persons = list(Person.load(db)(FooObject()))
+    # Query the extra columns for all persons at once instead of once per person
+    extra = {row.id: row for row in Person.query(db, minidb.columns(Person.c.id,
+                                                                    Person.c.username.upper('up'),
+                                                                    Person.c.username.lower('down'),
+                                                                    Person.c.foo('foox'),
+                                                                    Person.c.foo),
+                                                 where=Person.c.id.in_([p.id for p in persons]))}
+    for p in persons:
+        print(p.id, p.username, p.mail, extra[p.id])
 
     print('=' * 30)
     print('queries')
     print('=' * 30)
 
-    highest_id = next(Person.query(db, Person.c.id.max('max'))).max
+    highest_id = Person.query_one(db, Person.c.id.max('max')).max
     print('highest id:', highest_id)
 
-    average_age = next(WithoutConstructor.query(db, WithoutConstructor.c.age.avg('average'))).average
+    average_age = WithoutConstructor.query_one(db, WithoutConstructor.c.age.avg('average')).average
     print('average age:', average_age)
 
     all_ages = list(WithoutConstructor.c.age.query(db, order_by=WithoutConstructor.c.age.desc))
@@ -24,15 +24,17 @@
 
 import sqlite3
 import threading
-import inspect
 import functools
 import types
-import collections
 import weakref
 import sys
 import json
 import datetime
 import logging
+import contextlib
+import operator
+import dis
+import itertools
 
 
 __author__ = 'Thomas Perl <m@thp.io>'
@@ -49,7 +51,7 @@ __all__ = [
     'UnknownClass',
 
     # Utility functions
-    'columns', 'func', 'literal',
+    'columns', 'func', 'literal', 'and_', 'or_',
 
     # Decorator for registering converters
     'converter_for',
@@ -62,6 +64,10 @@ __all__ = [
 DEBUG_OBJECT_CACHE = False
 CONVERTERS = {}
 
+# Model classes and stores, whose generated functions have the converters built in
+_MODELS = weakref.WeakSet()
+_STORES = weakref.WeakSet()
+
 
 logger = logging.getLogger(__name__)
 
@@ -73,70 +79,415 @@ class UnknownClass(TypeError):
 def converter_for(type_):
     def decorator(f):
         CONVERTERS[type_] = f
+        # Converters registered after a model class (or store) was created are used, too
+        for class_ in list(_MODELS):
+            class_.__init__ = _make_init(class_)
+        for store in list(_STORES):
+            store._regenerate()
         return f
 
     return decorator
 
 
 def _get_all_slots(class_, include_private=False):
-    for clazz in reversed(inspect.getmro(class_)):
-        if hasattr(clazz, '__minidb_slots__'):
-            for name, type_ in clazz.__minidb_slots__.items():
-                if include_private or not name.startswith('_'):
-                    yield (name, type_)
+    # Computed once per class by MetaModel
+    return class_.__minidb_all_slots__ if include_private else class_.__minidb_columns__
+
+
+def _default_value(o, slot, cls):
+    value = getattr(o.__class__.__minidb_defaults__, slot, None)
+    if isinstance(value, types.FunctionType):
+        # Late-binding of default lambda (taking o as argument)
+        value = value(o)
+    if value is not None and cls not in CONVERTERS:
+        value = cls(value)
+    return value
 
 
 def _set_attribute(o, slot, cls, value):
     if value is None and hasattr(o.__class__, '__minidb_defaults__'):
-        value = getattr(o.__class__.__minidb_defaults__, slot, None)
-        if isinstance(value, types.FunctionType):
-            # Late-binding of default lambda (taking o as argument)
-            value = value(o)
-    if value is not None and cls not in CONVERTERS:
+        value = _default_value(o, slot, cls)
+    elif value is not None and cls not in CONVERTERS:
         value = cls(value)
     setattr(o, slot, value)
 
 
-class RowProxy(object):
-    def __init__(self, row, keys):
-        self._row = row
-        self._keys = keys
+# Instructions that make the result of a function depend on something other than its arguments
+_NONLOCAL_LOADS = {'LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_DEREF', 'LOAD_CLASSDEREF',
+                   'LOAD_FROM_DICT_OR_GLOBALS', 'LOAD_FROM_DICT_OR_DEREF'}
+
+
+def _only_uses_arguments(f):
+    code = f.__code__
+    return (f.__closure__ is None and f.__defaults__ is None and f.__kwdefaults__ is None and
+            not any(isinstance(const, types.CodeType) for const in code.co_consts) and
+            not any(instruction.opname in _NONLOCAL_LOADS for instruction in dis.get_instructions(code)))
+
+
+def _late_bind(class_, expr):
+    """Resolve a late-binding column lambda (e.g. lambda c: c.age.desc) for class_
+
+    Lambdas that only depend on their argument always return the same
+    expression, so they are only called once per class and lambda. Other
+    callables (e.g. bound methods or functools.partial objects) are called
+    every time. Query expressions are returned as-is."""
+    if not isinstance(expr, types.FunctionType):
+        if callable(expr) and not isinstance(expr, (Operation, Sequence, OperatorMixin)):
+            return expr(class_.c)
+        return expr
+
+    cache = class_.__minidb_late_bound__
+    code = expr.__code__
+    if code in cache:
+        return cache[code]
+
+    result = expr(class_.c)
+    if _only_uses_arguments(expr):
+        cache[code] = result
+    return result
+
+
+def _compile_function(name, lines, namespace):
+    exec(compile('\n'.join(lines), '<minidb {}>'.format(name), 'exec'), namespace)
+    return namespace[name]
+
+
+def _make_loader(class_, minidb_attr, primary_key):
+    """Generate a function that creates an instance of class_ from a row
+
+    The generated function is equivalent to instantiating class_ with the
+    (deserialized) values of the row as keyword arguments, but assigns the
+    attributes directly instead of going through model_init(). For stores
+    with smartupdate, the stored values are remembered (see Store._snapshot())."""
+    namespace = {'_new': object.__new__, '_cls': class_, '_default': _default_value,
+                 '_init': class_.__dict__.get('__minidb_init__')}
+    has_defaults = hasattr(class_, '__minidb_defaults__')
+    index = {name: i for i, (name, type_) in enumerate(class_.__minidb_columns__)}
+
+    lines = ['def load(row, store, args):',
+             '    o = _new(_cls)']
+    for i, (name, type_) in enumerate(class_.__minidb_all_slots__):
+        namespace['_t%d' % i] = type_
+        if name in index:
+            lines.append('    v = row[%d]' % index[name])
+            if type_ in CONVERTERS:
+                namespace['_c%d' % i] = CONVERTERS[type_]
+                lines.extend(['    if v is not None:',
+                              '        v = _c%d(v, False)' % i])
+            else:
+                # SQLite mostly returns values of the right type already (int, float, bytes)
+                lines.extend(['    if v is not None:',
+                              '        if v.__class__ is not _t%d:' % i,
+                              '            v = _t%d(v)' % i])
+            if has_defaults:
+                lines.extend(['    else:',
+                              '        v = _default(o, %r, _t%d)' % (name, i)])
+            lines.append('    o.%s = v' % name)
+        elif has_defaults:
+            lines.append('    o.%s = _default(o, %r, _t%d)' % (name, name, i))
+        else:
+            lines.append('    o.%s = None' % name)
+
+    stored = ['row[%d]' % i for i, slot in enumerate(class_.__minidb_columns__) if slot != primary_key]
+    pk = 'row[%d]' % index[primary_key[0]]
+    lines.extend(['    if store.smartupdate:',
+                  '        o.__minidb_stored__ = store._snapshot(_cls, %s, [%s])' % (pk, ', '.join(stored))])
+    if namespace['_init'] is not None:
+        # Like when instantiating, stored columns of base classes go to __init__() as keyword arguments
+        inherited = [name for name, type_ in class_.__minidb_columns__
+                     if name not in class_.__minidb_slots__ and name != primary_key[0]]
+        if inherited:
+            lines.append('    kwargs = {}')
+            for name in inherited:
+                lines.extend(['    if row[%d] is not None:' % index[name],
+                              '        kwargs[%r] = o.%s' % (name, name)])
+            lines.append('    _init(o, *args, **kwargs)')
+        else:
+            lines.append('    _init(o, *args)')
+    lines.extend(['    o.%s = store' % minidb_attr,
+                  '    return o'])
+
+    return _compile_function('load', lines, namespace)
+
+
+def _make_init(class_):
+    """Generate the __init__() function of class_
+
+    The generated function is equivalent to model_init() for instances of
+    class_, with the attributes assigned directly."""
+    all_slots = class_.__minidb_all_slots__
+    namespace = {'_cls': class_, '_model_init': model_init, '_default': _default_value,
+                 '_names': frozenset(name for name, type_ in all_slots),
+                 '_own': frozenset(class_.__minidb_slots__).union((Store.PRIMARY_KEY[0],)),
+                 '_init': class_.__dict__.get('__minidb_init__')}
+    has_defaults = hasattr(class_, '__minidb_defaults__')
+
+    lines = ['def __init__(self, *args, **kwargs):',
+             '    if self.__class__ is not _cls:',
+             '        return _model_init(self, *args, **kwargs)',
+             '    if kwargs and not _names.issuperset(kwargs):',
+             "        raise KeyError('Invalid keyword argument(s): %r' % set(kwargs).difference(_names))"]
+    for i, (name, type_) in enumerate(all_slots):
+        namespace['_t%d' % i] = type_
+        lines.append('    v = kwargs.get(%r)' % name)
+        if type_ not in CONVERTERS:
+            lines.extend(['    if v is not None:',
+                          '        v = _t%d(v)' % i])
+            if has_defaults:
+                lines.append('    else:')
+        elif has_defaults:
+            lines.append('    if v is None:')
+        if has_defaults:
+            lines.append('        v = _default(self, %r, _t%d)' % (name, i))
+        lines.append('    self.%s = v' % name)
+
+    if namespace['_init'] is not None:
+        # Keyword arguments that are not columns of the class itself go to its __init__()
+        lines.append('    _init(self, *args, **{k: v for k, v in kwargs.items() if k not in _own})')
+
+    return _compile_function('__init__', lines, namespace)
+
+
+def _make_repr(class_):
+    """Generate a __repr__() function for class_ that formats its columns
+
+    Columns that have not been assigned (e.g. in a partially initialized
+    object) are shown as None."""
+    attrs = ', '.join('%s={_getattr(self, %r, None)!r}' % (name, name) for name, type_ in class_.__minidb_columns__)
+    lines = ['def __repr__(self):',
+             '    return f%r' % ('<%s(%s)>' % (class_.__name__, attrs),)]
+
+    result = _compile_function('__repr__', lines, {'_getattr': getattr})
+    result.__minidb_generated__ = True
+    return result
+
+
+# Values that Store.serialize() passes to SQLite unchanged
+_NATIVE_TYPES = frozenset((type(None), int, float, bytes, str))
+
+
+def _make_dumper(class_, serialize, primary_key, inline):
+    """Generate a function that returns the serialized column values of an object
+
+    The values are returned in the column order of the INSERT and UPDATE
+    statements, i.e. all columns of class_ except for the primary key. If
+    inline is true, the converter of each column (or the check for values
+    that need no conversion) is inlined instead of calling serialize()."""
+    namespace = {'_s': serialize, '_native': _NATIVE_TYPES}
+    lines = ['def dump(o):']
+    values = []
+    for i, (name, type_) in enumerate(class_.__minidb_columns__):
+        if (name, type_) != primary_key:
+            namespace['_t%d' % i] = type_
+            lines.append('    v%d = o.%s' % (i, name))
+            if not inline:
+                lines.append('    v%d = _s(v%d, _t%d)' % (i, i, i))
+            elif type_ in CONVERTERS:
+                namespace['_c%d' % i] = CONVERTERS[type_]
+                lines.extend(['    if v%d is not None:' % i,
+                              '        v%d = _c%d(v%d, True)' % (i, i, i)])
+            else:
+                lines.extend(['    if v%d.__class__ not in _native:' % i,
+                              '        v%d = _s(v%d, _t%d)' % (i, i, i)])
+            values.append('v%d' % i)
+
+    lines.append('    return [%s]' % ', '.join(values))
+
+    return _compile_function('dump', lines, namespace)
+
+
+def _make_decoder(columns, column_types, deserialize, inline):
+    """Generate a function that turns a result row into a RowProxy
+
+    column_types has the type of each result column (or None for values
+    that are returned as-is). If inline is true, converters and type casts
+    are inlined instead of calling deserialize() for each value."""
+    proxy = _row_proxy_class(columns)
+    if not any(type_ is not None for type_ in column_types):
+        return proxy
+
+    namespace = {'_proxy': proxy, '_d': deserialize}
+    names = ['v%d' % i for i in range(len(columns))]
+    lines = ['def decode(row):',
+             '    %s, = row' % ', '.join(names)]
+    for i, type_ in enumerate(column_types):
+        if type_ is None:
+            continue
+
+        namespace['_t%d' % i] = type_
+        if not inline:
+            lines.append('    v%d = _d(v%d, _t%d)' % (i, i, i))
+        elif type_ in CONVERTERS:
+            namespace['_c%d' % i] = CONVERTERS[type_]
+            lines.extend(['    if v%d is not None:' % i,
+                          '        v%d = _c%d(v%d, False)' % (i, i, i)])
+        else:
+            lines.extend(['    if v%d is not None and not isinstance(v%d, _t%d):' % (i, i, i),
+                          '        v%d = _t%d(v%d)' % (i, i, i)])
+    lines.append('    return _proxy((%s,))' % ', '.join(names))
+
+    return _compile_function('decode', lines, namespace)
+
+
+class RowProxy(tuple):
+    """A result row, accessible by index, by column name and as attributes
+
+    Each set of result columns gets its own subclass (see _row_proxy_class())
+    with the column names in _keys, their indices in _index and a property
+    per column name."""
+    __slots__ = ()
+    _keys = ()
+    _index = {}
 
     def __getitem__(self, key):
         if isinstance(key, str):
-            try:
-                index = self._keys.index(key)
-            except ValueError:
-                raise KeyError(key)
-
-            return self._row[index]
+            return tuple.__getitem__(self, self._index[key])
 
-        return self._row[key]
+        return tuple.__getitem__(self, key)
 
     def __getattr__(self, attr):
-        if attr not in self._keys:
+        if attr not in self._index:
             raise AttributeError(attr)
 
         return self[attr]
 
-    def __repr__(self):
-        return repr(self._row)
-
     def keys(self):
         return self._keys
 
+    def __reduce__(self):
+        # The subclasses are created on the fly, so pickles refer to the column names instead
+        return _restore_row_proxy, (self._keys, tuple(self))
+
+
+def _restore_row_proxy(keys, values):
+    return _row_proxy_class(keys)(values)
+
+
+@functools.lru_cache()
+def _row_proxy_class(keys):
+    d = {'__slots__': (), '_keys': keys, '_index': {}}
+    for index, key in enumerate(keys):
+        # The first column wins if there are several with the same name
+        d['_index'].setdefault(key, index)
+        # Columns named like tuple methods (e.g. "count") take precedence over them
+        if key.isidentifier() and not key.startswith('_') and key not in d and key not in RowProxy.__dict__:
+            d[key] = property(operator.itemgetter(index))
+    return type(RowProxy.__name__, (RowProxy,), d)
+
+
+class _Snapshot(list):
+    # Serialized column values of a row as last loaded or saved (for smartupdate)
+    __slots__ = ('__weakref__', 'generation')
+
 
 class Store(object):
+    """Store for model objects, backed by a single SQLite connection
+
+    A store can be shared between threads. Writes are serialized with its
+    lock, and so are reads while a transaction() is active. Other reads do
+    not wait for writes (with a serialized SQLite build), and see the
+    uncommitted changes made through the shared connection by any thread.
+    (The objects returned by load() are fetched while iterating over them,
+    so only the statement itself waits for an active transaction.)
+
+    With smartupdate, saving an object only writes the columns that differ
+    from the values last loaded or saved through the store, so rows changed
+    by other connections should be loaded again before changing them.
+    """
     PRIMARY_KEY = ('id', int)
     MINIDB_ATTR = '_minidb'
 
-    def __init__(self, filename=':memory:', debug=False, smartupdate=False, vacuum_on_close=True):
-        self.db = sqlite3.connect(filename, check_same_thread=False)
+    # Size of the sqlite3 cache of prepared statements (per connection)
+    CACHED_STATEMENTS = 256
+    # Number of generated SELECT statements that query() keeps around
+    QUERY_CACHE_SIZE = 256
+    # Most parameters per statement that all SQLite versions support (SQLITE_MAX_VARIABLE_NUMBER)
+    MAX_VARIABLES = 999
+
+    # Settings for file-based stores, the pragmas argument adds to (or with None, removes) them
+    PRAGMAS = {
+        # Write-ahead logging with fewer fsyncs; committed transactions can
+        # only be lost on power loss, and the database stays consistent
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # Read pages through a memory map and keep up to 64 MiB of them cached
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, filename=':memory:', debug=False, smartupdate=False, vacuum_on_close=True, pragmas=None):
+        # URI filenames (e.g. file::memory:?cache=shared or file:data.db?mode=ro) are passed on as URIs
+        uri = isinstance(filename, str) and filename.startswith('file:')
+        self.db = sqlite3.connect(filename, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS, uri=uri)
+        self._in_memory = (filename == ':memory:' or
+                           uri and (filename.startswith('file::memory:') or 'mode=memory' in filename))
+        for name, value in dict({} if self._in_memory else self.PRAGMAS, **(pragmas or {})).items():
+            if value is not None:
+                self.db.execute(f'PRAGMA {name}={value}')
+        self.filename = filename
         self.debug = debug
         self.smartupdate = smartupdate
         self.vacuum_on_close = vacuum_on_close
         self.registered = {}
+        self._schemas = {}
+        self._statements = {}
+        self._loaders = {}
+        self._dumpers = {}
+        self._queries = {}
+        self._decoders = {}
+        # Snapshots of stored rows by (class, id), kept alive by the objects using them
+        self._snapshots = weakref.WeakValueDictionary()
+        self._generation = 0
         self.lock = threading.RLock()
+        self._transaction_depth = 0
+        _STORES.add(self)
+        # A serialized SQLite build allows using the connection from many threads
+        # at once, so reads do not need to wait for each other (or for writes)
+        self._unlocked_reads = (sqlite3.threadsafety == 3)
+        # Reads running without the lock, which a transaction() waits for before it starts
+        self._readers = 0
+        self._readers_changed = threading.Condition(threading.Lock())
+        self._reading = threading.local()
+
+    @property
+    def _read_lock(self):
+        if not self._unlocked_reads:
+            return self.lock
+        return self._unlocked_read()
+
+    @contextlib.contextmanager
+    def _unlocked_read(self):
+        # Nested reads in the same thread must not wait for a transaction waiting for them
+        if getattr(self._reading, 'depth', 0):
+            self._reading.depth += 1
+            try:
+                yield
+            finally:
+                self._reading.depth -= 1
+            return
+
+        # While a transaction() is active, reads wait for it (and do not see its uncommitted
+        # changes); checking and counting readers together means no transaction can start
+        # in between, and transaction() only begins after the counted reads have finished
+        with self._readers_changed:
+            locked = bool(self._transaction_depth)
+            if not locked:
+                self._readers += 1
+
+        if locked:
+            with self.lock:
+                yield
+            return
+
+        self._reading.depth = 1
+        try:
+            yield
+        finally:
+            self._reading.depth = 0
+            with self._readers_changed:
+                self._readers -= 1
+                self._readers_changed.notify_all()
 
     def __enter__(self):
         return self
@@ -147,39 +498,133 @@ class Store(object):
 
         self.close()
 
+    @property
+    def debug(self):
+        return self._debug
+
+    @debug.setter
+    def debug(self, debug):
+        self._debug = debug
+        self.__dict__.pop('_execute', None)
+        self.__dict__.pop('_executemany', None)
+        if not debug:
+            # Without debug output, statements go straight to the connection
+            # (unless a subclass overrides how they are executed)
+            if type(self)._execute is Store._execute:
+                self._execute = self.db.execute
+            if type(self)._executemany is Store._executemany:
+                self._executemany = self.db.executemany
+
     def _execute(self, sql, args=None):
         if args is None:
-            if self.debug:
-                logger.debug('%s', sql)
+            logger.debug('%s', sql)
             return self.db.execute(sql)
         else:
-            if self.debug:
-                logger.debug('%s %r', sql, args)
+            logger.debug('%s %r', sql, args)
             return self.db.execute(sql, args)
 
+    def _executemany(self, sql, seq_of_args):
+        logger.debug('%s (many)', sql)
+        return self.db.executemany(sql, seq_of_args)
+
     def _schema(self, class_):
-        if class_ not in self.registered.values():
-            raise UnknownClass('{} was never registered'.format(class_))
-        return (class_.__name__, list(_get_all_slots(class_)))
+        try:
+            return self._schemas[class_]
+        except KeyError:
+            raise UnknownClass('{} was never registered'.format(class_)) from None
 
     def commit(self):
         with self.lock:
             self.db.commit()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a block of statements in a single transaction
+
+        The transaction is committed if the block succeeds and rolled back
+        if it raises an exception. Changes made before the block are committed
+        when it starts. When nesting transactions, a savepoint is used instead.
+        """
+        with self.lock:
+            with self._readers_changed:
+                self._transaction_depth += 1
+                self._readers_changed.wait_for(lambda: not self._readers)
+            try:
+                if self._transaction_depth > 1:
+                    self._execute('SAVEPOINT minidb')
+                    try:
+                        yield self
+                    except BaseException:
+                        self._execute('ROLLBACK TO minidb')
+                        self._forget_snapshots()
+                        raise
+                    finally:
+                        self._execute('RELEASE minidb')
+                else:
+                    # Earlier writes leave an implicit transaction open, which would
+                    # otherwise swallow this one (and never be committed by it)
+                    if self.db.in_transaction:
+                        self.db.commit()
+                    # Take the write lock up front, so other connections cannot make
+                    # the transaction fail with SQLITE_BUSY when it starts writing
+                    self._execute('BEGIN IMMEDIATE')
+                    try:
+                        yield self
+                    except BaseException:
+                        self.db.rollback()
+                        self._forget_snapshots()
+                        raise
+                    else:
+                        self.db.commit()
+            finally:
+                with self._readers_changed:
+                    self._transaction_depth -= 1
+
+    def _snapshot(self, class_, pk, values):
+        """Remember the serialized values of a stored row, for smartupdate
+
+        All objects loaded or saved for the same row share the snapshot, so
+        changes saved through one of them are seen when saving the others."""
+        with self.lock:
+            snapshot = self._snapshots.get((class_, pk))
+            if snapshot is None:
+                snapshot = self._snapshots[class_, pk] = _Snapshot()
+            snapshot[:] = values
+            snapshot.generation = self._generation
+            return snapshot
+
+    def _stored_values(self, class_, pk):
+        # Returns None if the row has to be read again to know its values
+        snapshot = self._snapshots.get((class_, pk))
+        if snapshot is not None and snapshot.generation == self._generation:
+            return snapshot
+        return None
+
+    def _forget_snapshots(self):
+        # After a rollback (or deleting rows by a condition), the stored values are unknown
+        self._generation += 1
+
     def vacuum(self):
         with self.lock:
             self._execute('VACUUM')
 
-    def close(self):
+    def close(self, vacuum=None):
+        """Close the database, vacuum overrides the vacuum_on_close setting of the store"""
+        if vacuum is None:
+            vacuum = self.vacuum_on_close
+
         with self.lock:
             self.db.isolation_level = None
-            if self.vacuum_on_close:
-                self._execute('VACUUM')
+            # An in-memory database is gone after closing, nothing to compact, and
+            # without free pages (e.g. from deleted rows) VACUUM would not shrink the file
+            if vacuum and not self._in_memory:
+                if self._execute('PRAGMA freelist_count').fetchone()[0]:
+                    self._execute('VACUUM')
             self.db.close()
 
     def _ensure_schema(self, table, slots):
         with self.lock:
-            cur = self._execute('PRAGMA table_info(%s)' % table)
+            cur = self._execute(f'PRAGMA table_info({table})')
             available = cur.fetchall()
 
             def column(name, type_, primary=True):
@@ -208,10 +653,10 @@ class Store(object):
 
                 missing_slots = [(name, type_) for name, type_ in slots if name not in (n for n, _ in available)]
                 for name, type_ in missing_slots:
-                    self._execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, column(name, type_)))
+                    self._execute(f'ALTER TABLE {table} ADD COLUMN {name} {column(name, type_)}')
             else:
-                self._execute('CREATE TABLE %s (%s)' % (table, ', '.join('{} {}'.format(name, column(name, type_))
-                                                                         for name, type_ in slots)))
+                columns = ', '.join(f'{name} {column(name, type_)}' for name, type_ in slots)
+                self._execute(f'CREATE TABLE {table} ({columns})')
 
     def register(self, class_, upgrade=False):
         if not issubclass(class_, Model):
@@ -223,12 +668,42 @@ class Store(object):
             raise TypeError('{} is already registered {}'.format(class_.__name__, self.registered[class_.__name__]))
 
         with self.lock:
+            previous = self.registered.get(class_.__name__)
             self.registered[class_.__name__] = class_
-            table, slots = self._schema(class_)
+            self._schemas.pop(previous, None)
+            self._schemas[class_] = table, slots = (class_.__name__, _get_all_slots(class_))
             self._ensure_schema(table, slots)
+            self._statements.pop(previous, None)
+            self._statements[class_] = self._build_statements(table, slots)
+            self._loaders.pop(previous, None)
+            self._dumpers.pop(previous, None)
+            self._generate_functions(class_)
 
         return class_
 
+    def _generate_functions(self, class_):
+        self._loaders[class_] = _make_loader(class_, self.MINIDB_ATTR, self.PRIMARY_KEY)
+        self._dumpers[class_] = _make_dumper(class_, self.serialize, self.PRIMARY_KEY,
+                                             type(self).serialize is Store.serialize)
+
+    def _regenerate(self):
+        # Called by converter_for(), so that the generated functions use the new converter
+        with self.lock:
+            for class_ in self._schemas:
+                self._generate_functions(class_)
+            self._decoders.clear()
+
+    def _build_statements(self, table, slots):
+        # SQL statements that only depend on the schema are built once at register time
+        pk_name, pk_type = self.PRIMARY_KEY
+        names = [name for name, type_ in slots if (name, type_) != self.PRIMARY_KEY]
+        return {
+            'insert': f'INSERT INTO {table} ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+            'update': f'UPDATE {table} SET {", ".join(f"{name}=?" for name in names)} WHERE {pk_name} = ?',
+            'select': f'SELECT {", ".join(name for name, type_ in slots)} FROM {table}',
+            'delete': f'DELETE FROM {table} WHERE {pk_name} = ?',
+        }
+
     def serialize(self, v, t):
         if v is None:
             return None
@@ -266,7 +741,8 @@ class Store(object):
             pk = getattr(o, pk_name)
             assert pk is not None
 
-            self._execute('DELETE FROM %s WHERE %s = ?' % (table, pk_name), [pk])
+            self._execute(self._statements[o.__class__]['delete'], [pk])
+            self._snapshots.pop((o.__class__, pk), None)
             setattr(o, pk_name, None)
 
     def _update(self, o):
@@ -277,174 +753,360 @@ class Store(object):
             assert self.PRIMARY_KEY in slots
             pk_name, pk_type = self.PRIMARY_KEY
 
-            if self.smartupdate:
-                existing = dict(next(self.query(o.__class__, where=lambda c:
-                                                getattr(c, pk_name) == getattr(o, pk_name))))
-            else:
-                existing = {}
+            pk = getattr(o, pk_name)
+            values = self._dumpers[o.__class__](o)
+            if not self.smartupdate:
+                self._execute(self._statements[o.__class__]['update'], values + [pk])
+                return
 
-            values = [(name, type_, getattr(o, name, None))
-                      for name, type_ in slots if (name, type_) != self.PRIMARY_KEY and
-                      (name not in existing or getattr(o, name, None) != existing[name])]
+            # The serialized values of the last load or save are compared with the
+            # current ones, so only changed columns are written (without a SELECT)
+            stored = self._stored_values(o.__class__, pk)
+            if stored is None:
+                row = self._execute(self._statements[o.__class__]['select'] + f' WHERE {pk_name} = ?', [pk]).fetchone()
+                stored = [value for slot, value in zip(slots, row) if slot != self.PRIMARY_KEY]
 
-            if self.smartupdate and self.debug:
-                for name, type_, to_value in values:
+            names = [name for name, type_ in slots if (name, type_) != self.PRIMARY_KEY]
+            changed = [(name, old, new) for name, old, new in zip(names, stored, values) if old != new]
+
+            if self.debug:
+                for name, old, new in changed:
                     logger.debug('%s %s', '{}(id={})'.format(table, o.id),
-                                 '{}: {} -> {}'.format(name, existing[name], to_value))
+                                 '{}: {} -> {}'.format(name, old, new))
 
-            if not values:
-                # No values have changed - nothing to update
-                return
+            if changed:
+                args = [new for name, old, new in changed]
+                args.append(pk)
+                self._execute(self._update_statement(o.__class__, tuple(name for name, old, new in changed)), args)
 
-            def gen_keys():
-                for name, type_, value in values:
-                    if value is not None:
-                        yield '{name}=?'.format(name=name)
-                    else:
-                        yield '{name}=NULL'.format(name=name)
+            o.__minidb_stored__ = self._snapshot(o.__class__, pk, values)
+
+    def _update_statement(self, class_, names):
+        # NULL values are bound as parameters, so the SQL only depends on the columns
+        statements = self._statements[class_]
+        sql = statements.get(('update', names))
+        if sql is None:
+            table, slots = self._schema(class_)
+            pk_name, pk_type = self.PRIMARY_KEY
+            sets = ', '.join(f'{name}=?' for name in names)
+            sql = statements['update', names] = f'UPDATE {table} SET {sets} WHERE {pk_name} = ?'
+        return sql
+
+    def update(self, o, **kwargs):
+        """Set the given attributes of a stored object and update only their columns"""
+        with self.lock:
+            table, slots = self._schema(o.__class__)
+
+            pk_name, pk_type = self.PRIMARY_KEY
+            pk = getattr(o, pk_name)
+            if pk is None:
+                raise KeyError('id is None (not stored in db?)')
+
+            types_ = dict(slots)
+            unmatched_kwargs = set(kwargs.keys()).difference(types_.keys()).union({pk_name}.intersection(kwargs))
+            if unmatched_kwargs:
+                raise KeyError('Invalid keyword argument(s): %r' % unmatched_kwargs)
+
+            if not kwargs:
+                return
 
-            def gen_values():
-                for name, type_, value in values:
-                    if value is not None:
-                        yield self.serialize(value, type_)
+            values = []
+            for name, value in kwargs.items():
+                type_ = types_[name]
+                if value is not None and type_ not in CONVERTERS:
+                    value = type_(value)
+                setattr(o, name, value)
+                values.append(self.serialize(value, type_))
 
-                yield getattr(o, pk_name)
+            stored = self._stored_values(o.__class__, pk) if self.smartupdate else None
+            if stored is not None:
+                names = [name for name, type_ in slots if (name, type_) != self.PRIMARY_KEY]
+                for name, value in zip(kwargs, values):
+                    stored[names.index(name)] = value
+            values.append(pk)
 
-            self._execute('UPDATE %s SET %s WHERE %s = ?' % (table, ', '.join(gen_keys()), pk_name), list(gen_values()))
+            self._execute(self._update_statement(o.__class__, tuple(kwargs)), values)
 
     def save(self, o):
         with self.lock:
-            table, slots = self._schema(o.__class__)
+            self._schema(o.__class__)
 
             # Save all values except for the primary key
-            slots = [(name, type_) for name, type_ in slots if (name, type_) != self.PRIMARY_KEY]
+            values = self._dumpers[o.__class__](o)
+            lastrowid = self._execute(self._statements[o.__class__]['insert'], values).lastrowid
+            if self.smartupdate:
+                o.__minidb_stored__ = self._snapshot(o.__class__, lastrowid, values)
+            return lastrowid
 
-            values = [self.serialize(getattr(o, name), type_) for name, type_ in slots]
-            return self._execute('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(name for name, type_ in slots),
-                                                                      ', '.join('?' * len(slots))), values).lastrowid
+    def save_many(self, class_, objects):
+        """Save many objects of the same class at once
 
-    def delete_where(self, class_, where):
+        Objects that are not yet stored are inserted using a single
+        executemany() call, objects that already have an id are updated.
+        """
+        objects = list(objects)
+        for o in objects:
+            if o.__class__ is not class_:
+                raise TypeError('{} is not an instance of {}'.format(o, class_.__name__))
+
+        with self.lock:
+            self._schema(class_)
+
+            new_objects = []
+            for o in objects:
+                if o.id is None:
+                    new_objects.append(o)
+                else:
+                    self._update(o)
+
+            if new_objects:
+                # Save all values except for the primary key
+                values = list(map(self._dumpers[class_], new_objects))
+                self._insert_many(class_, values)
+
+                # Rows inserted in one go get consecutive ids (new rows get max(id) + 1
+                # assigned, and we hold the lock), so derive them from the last one
+                last_id = self._execute('SELECT last_insert_rowid()').fetchone()[0]
+                for id_, o, stored in zip(itertools.count(last_id - len(new_objects) + 1), new_objects, values):
+                    o.id = id_
+                    if self.smartupdate:
+                        o.__minidb_stored__ = self._snapshot(class_, id_, stored)
+
+            cache = class_.__minidb_cache__
+            for o in objects:
+                if getattr(o, self.MINIDB_ATTR, None) is None:
+                    setattr(o, self.MINIDB_ATTR, self)
+                cache[o.id] = o
+
+        return objects
+
+    def _insert_statement(self, class_, names, rows):
+        # INSERT statements for some columns (names) or many rows at once are cached
+        statements = self._statements[class_]
+        if names is None and rows == 1:
+            return statements['insert']
+
+        sql = statements.get(('insert', names, rows))
+        if sql is None:
+            table, slots = self._schema(class_)
+            columns = names or tuple(name for name, type_ in slots if (name, type_) != self.PRIMARY_KEY)
+            row = f'({", ".join("?" * len(columns))})'
+            values = ', '.join([row] * rows)
+            sql = statements['insert', names, rows] = f'INSERT INTO {table} ({", ".join(columns)}) VALUES {values}'
+        return sql
+
+    def _insert_many(self, class_, values, names=None):
+        # Inserting many rows per statement (INSERT ... VALUES (...), (...), ...) saves
+        # running the statement for each row; the rows get their ids in this order
+        per_statement = max(1, self.MAX_VARIABLES // len(values[0]))
+        batched = len(values) - len(values) % per_statement if per_statement > 1 else 0
+        if batched:
+            self._executemany(self._insert_statement(class_, names, per_statement),
+                              (list(itertools.chain.from_iterable(values[i:i + per_statement]))
+                               for i in range(0, batched, per_statement)))
+
+        if batched < len(values):
+            self._executemany(self._insert_statement(class_, names, 1), values[batched:])
+
+    def insert_many(self, class_, rows, columns=None):
+        """Insert rows of column values without creating objects
+
+        Each row is a dict or a sequence of the values of columns (by default,
+        all columns except for the primary key, in the order of the class).
+        Dicts may leave out columns, but must not have keys for other columns.
+        The values are serialized like attributes, but default values are not
+        applied. Returns the number of inserted rows.
+        """
         with self.lock:
             table, slots = self._schema(class_)
 
-            if isinstance(where, types.FunctionType):
-                # Late-binding of where
-                where = where(class_.c)
+            types_ = dict(slots)
+            if columns is None:
+                names = tuple(name for name, type_ in slots if (name, type_) != self.PRIMARY_KEY)
+            else:
+                names = tuple(columns)
+                unmatched_columns = set(names).difference(types_)
+                if unmatched_columns:
+                    raise KeyError('Invalid column(s): %r' % unmatched_columns)
+            if not names:
+                raise ValueError('No columns to insert for %s' % class_.__name__)
+
+            serialize = self.serialize
+            column_types = [(i, name, types_[name]) for i, name in enumerate(names)]
+            known = frozenset(names)
+            values = []
+            for row in rows:
+                if isinstance(row, dict):
+                    # A misspelled key would otherwise silently insert NULL for its column
+                    if not known.issuperset(row):
+                        raise ValueError('Invalid column(s): %r' % set(row).difference(known))
+                    values.append([serialize(row.get(name), type_) for i, name, type_ in column_types])
+                else:
+                    values.append([serialize(row[i], type_) for i, name, type_ in column_types])
+            if values:
+                self._insert_many(class_, values, names)
+
+            return len(values)
+
+    def delete_many(self, class_, objects):
+        """Delete many stored objects of the same class at once
+
+        The objects are deleted with DELETE ... WHERE id IN (...) statements
+        for up to MAX_VARIABLES objects each.
+        """
+        objects = list(objects)
+        for o in objects:
+            if o.__class__ is not class_:
+                raise TypeError('{} is not an instance of {}'.format(o, class_.__name__))
+            elif o.id is None:
+                raise KeyError('id is None (not stored in db?)')
+
+        with self.lock:
+            table, slots = self._schema(class_)
+
+            pk_name, pk_type = self.PRIMARY_KEY
+            pks = [getattr(o, pk_name) for o in objects]
+            for i in range(0, len(pks), self.MAX_VARIABLES):
+                chunk = pks[i:i + self.MAX_VARIABLES]
+                self._execute(f'DELETE FROM {table} WHERE {pk_name} IN ({", ".join("?" * len(chunk))})', chunk)
+
+            cache = class_.__minidb_cache__
+            for o in objects:
+                cache.pop(getattr(o, pk_name), None)
+                self._snapshots.pop((class_, getattr(o, pk_name)), None)
+                setattr(o, pk_name, None)
+
+    def delete_where(self, class_, where):
+        with self.lock:
+            table, slots = self._schema(class_)
 
-            ssql, args = where.tosql()
-            sql = 'DELETE FROM %s WHERE %s' % (table, ssql)
+            ssql, args = _late_bind(class_, where).tosql()
+            sql = f'DELETE FROM {table} WHERE {ssql}'
+            self._forget_snapshots()
             return self._execute(sql, args).rowcount
 
     def delete_all(self, class_):
         self.delete_where(class_, literal('1'))
 
     def count_rows(self, class_):
-        return next(self.query(class_, func.count(literal('*'))))[0]
+        return self.query_one(class_, func.count(literal('*')))[0]
 
-    def query(self, class_, select=None, where=None, order_by=None, group_by=None, limit=None):
-        with self.lock:
-            table, slots = self._schema(class_)
-            attr_to_type = dict(slots)
-
-            sql = []
-            args = []
-
-            if select is None:
-                select = literal('*')
-
-            if isinstance(select, types.FunctionType):
-                # Late-binding of columns
-                select = select(class_.c)
-
-            # Select can always be a sequence
-            if not isinstance(select, Sequence):
-                select = Sequence([select])
-
-            # Look for RenameOperation operations in the SELECT sequence and
-            # remember the column types, so we can decode values properly later
-            for arg in select.args:
-                if isinstance(arg, Operation):
-                    if isinstance(arg.a, RenameOperation):
-                        if isinstance(arg.a.column, Column):
-                            attr_to_type[arg.a.name] = arg.a.column.type_
-
-            ssql, sargs = select.tosql()
-            sql.append('SELECT %s FROM %s' % (ssql, table))
-            args.extend(sargs)
-
-            if where is not None:
-                if isinstance(where, types.FunctionType):
-                    # Late-binding of columns
-                    where = where(class_.c)
-                wsql, wargs = where.tosql()
-                sql.append('WHERE %s' % (wsql,))
-                args.extend(wargs)
-
-            if order_by is not None:
-                if isinstance(order_by, types.FunctionType):
-                    # Late-binding of columns
-                    order_by = order_by(class_.c)
-
-                osql, oargs = order_by.tosql()
-                sql.append('ORDER BY %s' % (osql,))
-                args.extend(oargs)
-
-            if group_by is not None:
-                if isinstance(group_by, types.FunctionType):
-                    # Late-binding of columns
-                    group_by = group_by(class_.c)
-
-                gsql, gargs = group_by.tosql()
-                sql.append('GROUP BY %s' % (gsql,))
-                args.extend(gargs)
+    def _build_select(self, class_, select, where, order_by, group_by, limit):
+        table, slots = self._schema(class_)
+        attr_to_type = dict(slots)
+
+        sql = []
+        args = []
 
+        if select is None:
+            select = literal('*')
+
+        # Select can always be a sequence
+        if not isinstance(select, Sequence):
+            select = Sequence([select])
+
+        # Look for RenameOperation operations in the SELECT sequence and
+        # remember the column types, so we can decode values properly later
+        for arg in select.args:
+            if isinstance(arg, Operation):
+                if isinstance(arg.a, RenameOperation):
+                    if isinstance(arg.a.column, Column):
+                        attr_to_type[arg.a.name] = arg.a.column.type_
+
+        ssql, sargs = select.tosql()
+        sql.append(f'SELECT {ssql} FROM {table}')
+        args.extend(sargs)
+
+        if where is not None:
+            wsql, wargs = where.tosql()
+            sql.append(f'WHERE {wsql}')
+            args.extend(wargs)
+
+        if order_by is not None:
+            osql, oargs = order_by.tosql()
+            sql.append(f'ORDER BY {osql}')
+            args.extend(oargs)
+
+        if group_by is not None:
+            gsql, gargs = group_by.tosql()
+            sql.append(f'GROUP BY {gsql}')
+            args.extend(gargs)
+
+        if limit:
+            sql.append('LIMIT ?')
+
+        return ' '.join(sql), args, attr_to_type
+
+    def _select(self, class_, select, where, order_by, group_by, limit):
+        with self._read_lock:
+            parts = tuple(_late_bind(class_, part) for part in (select, where, order_by, group_by))
+
+            # The generated SQL only depends on the (immutable) query expressions, so
+            # it is cached by their identity; the cache entry keeps them alive
+            key = (class_, limit is not None) + tuple(map(id, parts))
+            cached = self._queries.get(key)
+            if cached is None:
+                if len(self._queries) >= self.QUERY_CACHE_SIZE:
+                    self._queries.clear()
+                cached = self._queries[key] = (parts,) + self._build_select(class_, *parts, limit is not None)
+
+            _, sql, args, attr_to_type = cached
+            args = list(args)
             if limit is not None:
-                sql.append('LIMIT ?')
                 args.append(limit)
 
-            sql = ' '.join(sql)
-
             result = self._execute(sql, args)
-            columns = [d[0] for d in result.description]
+            columns = tuple(d[0] for d in result.description)
+            column_types = tuple(attr_to_type.get(name, None) for name in columns)
+
+            key = (columns, column_types)
+            decode = self._decoders.get(key)
+            if decode is None:
+                if len(self._decoders) >= self.QUERY_CACHE_SIZE:
+                    self._decoders.clear()
+                decode = self._decoders[key] = _make_decoder(columns, column_types, self.deserialize,
+                                                             type(self).deserialize is Store.deserialize)
+
+            return result, decode
 
-            def _decode(row, columns):
-                for name, value in zip(columns, row):
-                    type_ = attr_to_type.get(name, None)
-                    yield (self.deserialize(value, type_) if type_ is not None else value)
+    def query(self, class_, select=None, where=None, order_by=None, group_by=None, limit=None):
+        with self._read_lock:
+            result, decode = self._select(class_, select, where, order_by, group_by, limit)
+            return map(decode, result.fetchall())
 
-            return (RowProxy(tuple(_decode(row, columns)), columns) for row in list(result))
+    def query_one(self, class_, select=None, where=None, order_by=None, group_by=None):
+        """Like query(), but return only the first row (or None if there are no rows)"""
+        with self._read_lock:
+            result, decode = self._select(class_, select, where, order_by, group_by, 1)
+            row = result.fetchone()
+            return decode(row) if row is not None else None
 
     def load(self, class_, *args, **kwargs):
-        with self.lock:
+        with self._read_lock:
             query = kwargs.get('__query__', None)
             if '__query__' in kwargs:
                 del kwargs['__query__']
 
             table, slots = self._schema(class_)
-            sql = 'SELECT %s FROM %s' % (', '.join(name for name, type_ in slots), table)
+            statements = self._statements[class_]
+            sql = statements['select']
             if query:
-                if isinstance(query, types.FunctionType):
-                    # Late-binding of query
-                    query = query(class_.c)
-
-                ssql, aargs = query.tosql()
-                sql += ' WHERE %s' % ssql
+                ssql, aargs = _late_bind(class_, query).tosql()
+                sql += f' WHERE {ssql}'
                 sql_args = aargs
             elif kwargs:
-                sql += ' WHERE %s' % (' AND '.join('%s = ?' % k for k in kwargs))
+                names = tuple(kwargs)
+                sql = statements.get(('select', names))
+                if sql is None:
+                    where = ' AND '.join(f'{name} = ?' for name in names)
+                    sql = statements['select', names] = f'{statements["select"]} WHERE {where}'
                 sql_args = list(kwargs.values())
             else:
                 sql_args = []
             cur = self._execute(sql, sql_args)
+            loader = self._loaders[class_]
 
-            def apply(row):
-                row = zip(slots, row)
-                kwargs = {name: self.deserialize(v, type_) for (name, type_), v in row if v is not None}
-                o = class_(*args, **kwargs)
-                setattr(o, self.MINIDB_ATTR, self)
-                return o
-
-            return (x for x in (apply(row) for row in cur) if x is not None)
+            return map(loader, cur, itertools.repeat(self), itertools.repeat(args))
 
     def get(self, class_, *args, **kwargs):
         it = self.load(class_, *args, **kwargs)
@@ -459,11 +1121,14 @@ class Store(object):
 
 
 class Operation(object):
+    __slots__ = ('a', 'op', 'b', 'brackets', '_sql')
+
     def __init__(self, a, op=None, b=None, brackets=False):
         self.a = a
         self.op = op
         self.b = b
         self.brackets = brackets
+        self._sql = {}
 
     def _get_class(self, a):
         if isinstance(a, Column):
@@ -486,58 +1151,57 @@ class Operation(object):
         return Sequence([self, other])
 
     def argtosql(self, arg):
-        if isinstance(arg, Operation):
-            return arg.tosql(self.brackets)
-        elif isinstance(arg, Column):
-            return (arg.name, [])
-        elif isinstance(arg, RenameOperation):
-            columnname, args = arg.column.tosql()
-            return ('%s AS %s' % (columnname, arg.name), args)
-        elif isinstance(arg, Function):
-            sqls = []
-            argss = []
-            for farg in arg.args:
-                sql, args = self.argtosql(farg)
-                sqls.append(sql)
-                argss.extend(args)
-            return ['%s(%s)' % (arg.name, ', '.join(sqls)), argss]
-        elif isinstance(arg, Sequence):
-            sqls = []
-            argss = []
-            for farg in arg.args:
-                sql, args = self.argtosql(farg)
-                sqls.append(sql)
-                argss.extend(args)
-            return ['%s' % ', '.join(sqls), argss]
-        elif isinstance(arg, Literal):
-            return [arg.name, []]
-        if type(arg) in CONVERTERS:
-            return ('?', [CONVERTERS[type(arg)](arg, True)])
-
-        return ('?', [arg])
+        return _argtosql(arg, self.brackets)
 
     def tosql(self, brackets=False):
-        sql = []
-        args = []
-
-        ssql, aargs = self.argtosql(self.a)
-        sql.append(ssql)
-        args.extend(aargs)
+        # Operations are immutable, so the SQL only needs to be generated once
+        cached = self._sql.get(brackets)
+        if cached is None:
+            cached = self._sql[brackets] = self._tosql(brackets)
 
-        if self.op is not None:
-            sql.append(self.op)
+        sql, args = cached
+        return (sql, list(args))
 
-        if self.b is not None:
-            ssql, aargs = self.argtosql(self.b)
-            sql.append(ssql)
-            args.extend(aargs)
+    def _tosql(self, brackets):
+        # Walk nested operations (e.g. long chains of a & b & c ...) with an explicit
+        # stack instead of recursion, all other arguments are converted by argtosql()
+        sql = []
+        args = []
 
-        if brackets:
-            sql.insert(0, '(')
-            sql.append(')')
+        stack = [('operation', self, brackets)]
+        while stack:
+            kind, item, extra = stack.pop()
+            if kind == 'sql':
+                sql.append(item)
+            elif kind == 'arg':
+                ssql, aargs = extra.argtosql(item)
+                sql.append(ssql)
+                args.extend(aargs)
+            else:
+                cached = item._sql.get(extra)
+                if cached is not None:
+                    sql.append(cached[0])
+                    args.extend(cached[1])
+                    continue
+
+                # Pushed in reverse order of the output
+                if extra:
+                    stack.append(('sql', ')', None))
+                if item.b is not None:
+                    stack.append(item._operand(item.b))
+                if item.op is not None:
+                    stack.append(('sql', item.op, None))
+                stack.append(item._operand(item.a))
+                if extra:
+                    stack.append(('sql', '(', None))
 
         return (' '.join(sql), args)
 
+    def _operand(self, arg):
+        if type(arg) is Operation:
+            return ('operation', arg, self.brackets)
+        return ('arg', arg, self)
+
     def __and__(self, other):
         return Operation(self, 'AND', other, True)
 
@@ -552,7 +1216,70 @@ class Operation(object):
         return '{self.a!r} {self.op} {self.b!r}'.format(self=self)
 
 
+def _argtosql(arg, brackets=False):
+    # Operations nested in arg are converted with the given brackets setting
+    if isinstance(arg, Operation):
+        return arg.tosql(brackets)
+    elif isinstance(arg, Column):
+        return (arg.name, [])
+    elif isinstance(arg, RenameOperation):
+        columnname, args = arg.column.tosql()
+        return (f'{columnname} AS {arg.name}', args)
+    elif isinstance(arg, Function):
+        sql, args = _sequence_tosql(arg.args, brackets)
+        return (f'{arg.name}({sql})', args)
+    elif isinstance(arg, Sequence):
+        return _sequence_tosql(arg.args, brackets)
+    elif isinstance(arg, ValueList):
+        sql, args = _sequence_tosql(arg.values, brackets)
+        return (f'({sql})', args)
+    elif isinstance(arg, Literal):
+        return (arg.name, [])
+    if type(arg) in CONVERTERS:
+        return ('?', [CONVERTERS[type(arg)](arg, True)])
+
+    return ('?', [arg])
+
+
+def _sequence_tosql(seq, brackets=False):
+    sqls = []
+    argss = []
+    for arg in seq:
+        sql, args = _argtosql(arg, brackets)
+        sqls.append(sql)
+        argss.extend(args)
+    return (', '.join(sqls), argss)
+
+
+class NaryOperation(Operation):
+    """The same operator applied to many operands, without nesting (a AND b AND c)"""
+    __slots__ = ('args',)
+
+    def __init__(self, op, args):
+        super().__init__(args[0], op, None, True)
+        self.args = args
+
+    def _tosql(self, brackets):
+        sql = []
+        args = []
+        for arg in self.args:
+            ssql, aargs = self.argtosql(arg)
+            sql.append(ssql)
+            args.extend(aargs)
+
+        sql = f' {self.op} '.join(sql)
+        if brackets:
+            sql = f'( {sql} )'
+
+        return (sql, args)
+
+    def __repr__(self):
+        return (' %s ' % self.op).join(repr(arg) for arg in self.args)
+
+
 class Sequence(object):
+    __slots__ = ('args',)
+
     def __init__(self, args):
         self.args = args
 
@@ -560,14 +1287,27 @@ class Sequence(object):
         return ', '.join(repr(arg) for arg in self.args)
 
     def tosql(self):
-        return Operation(self).tosql()
+        return _sequence_tosql(self.args)
 
     def query(self, db, order_by=None, group_by=None, limit=None):
-        return Operation(self).query(db, order_by=order_by, group_by=group_by, limit=limit)
+        return self.args[0].class_.query(db, self, order_by=order_by, group_by=group_by, limit=limit)
 
     def __floordiv__(self, other):
-        self.args.append(other)
-        return self
+        return Sequence(list(self.args) + [other])
+
+
+class ValueList(object):
+    """A list of values in brackets, e.g. the right-hand side of IN
+
+    SQLite allows empty lists, "a IN ()" is false (and "a NOT IN ()" true)
+    even if a is NULL."""
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = tuple(values)
+
+    def __repr__(self):
+        return '(%s)' % ', '.join(repr(value) for value in self.values)
 
 
 def columns(*args):
@@ -578,6 +1318,34 @@ def columns(*args):
     return Sequence(args)
 
 
+def and_(*args):
+    """and_(a, b, c) -> a & b & c
+
+    Combine many conditions into a single (non-nested) AND expression.
+    Without conditions, this is always true.
+    """
+    if not args:
+        return literal('1')
+    elif len(args) == 1:
+        return args[0]
+
+    return NaryOperation('AND', args)
+
+
+def or_(*args):
+    """or_(a, b, c) -> a | b | c
+
+    Combine many conditions into a single (non-nested) OR expression.
+    Without conditions, this is always false.
+    """
+    if not args:
+        return literal('0')
+    elif len(args) == 1:
+        return args[0]
+
+    return NaryOperation('OR', args)
+
+
 class func(object):
     max = staticmethod(lambda *args: Function('max', *args))
     min = staticmethod(lambda *args: Function('min', *args))
@@ -598,6 +1366,8 @@ class func(object):
 
 
 class OperatorMixin(object):
+    __slots__ = ()
+
     __lt__ = lambda a, b: Operation(a, '<', b)
     __le__ = lambda a, b: Operation(a, '<=', b)
     __eq__ = lambda a, b: Operation(a, '=', b) if b is not None else Operation(a, 'IS NULL')
@@ -606,7 +1376,7 @@ class OperatorMixin(object):
     __ge__ = lambda a, b: Operation(a, '>=', b)
 
     __call__ = lambda a, name: RenameOperation(a, name)
-    tosql = lambda a: Operation(a).tosql()
+    tosql = lambda a: _argtosql(a)
     query = lambda a, db, where=None, order_by=None, group_by=None, limit=None: Operation(a).query(db, where=where,
                                                                                                    order_by=order_by,
                                                                                                    group_by=group_by,
@@ -614,6 +1384,7 @@ class OperatorMixin(object):
     __floordiv__ = lambda a, b: Sequence([a, b])
 
     like = lambda a, b: Operation(a, 'LIKE', b)
+    in_ = lambda a, b: Operation(a, 'IN', ValueList(b))
 
     avg = property(lambda a: Function('avg', a))
     max = property(lambda a: Function('max', a))
@@ -635,6 +1406,8 @@ class OperatorMixin(object):
 
 
 class RenameOperation(OperatorMixin):
+    __slots__ = ('column', 'name')
+
     def __init__(self, column, name):
         self.column = column
         self.name = name
@@ -644,6 +1417,8 @@ class RenameOperation(OperatorMixin):
 
 
 class Literal(OperatorMixin):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
@@ -661,6 +1436,8 @@ def literal(name):
 
 
 class Function(OperatorMixin):
+    __slots__ = ('name', 'args')
+
     def __init__(self, name, *args):
         self.name = name
         self.args = args
@@ -670,6 +1447,8 @@ class Function(OperatorMixin):
 
 
 class Column(OperatorMixin):
+    __slots__ = ('class_', 'name', 'type_')
+
     def __init__(self, class_, name, type_):
         self.class_ = class_
         self.name = name
@@ -678,6 +1457,33 @@ class Column(OperatorMixin):
     def __repr__(self):
         return '.'.join((self.class_.__name__, self.name))
 
+    # __getitem__() would otherwise make columns iterable (forever, as every index is valid)
+    __iter__ = None
+
+    def __getitem__(self, key):
+        """Extract a value from a JSON column in SQLite
+
+        For example, WithPayload.c.payload['a'] becomes json_extract(payload, ?)
+        with the path '$."a"' as argument. Integers index into arrays (negative
+        ones from the end), strings starting with $ are used as-is.
+        """
+        if self.type_ is not JSON:
+            raise TypeError('Column %s is not a JSON column' % self.name)
+
+        if isinstance(key, bool) or not isinstance(key, (int, str)):
+            raise TypeError('JSON path must be str or int, not %s' % type(key).__name__)
+        elif isinstance(key, int):
+            path = '$[%d]' % key if key >= 0 else '$[#%d]' % key
+        elif key.startswith('$'):
+            path = key
+        elif '"' in key:
+            # SQLite has no way of escaping quotes in JSON path labels
+            raise ValueError('JSON object key must not contain quotes: %r' % key)
+        else:
+            path = '$."%s"' % key
+
+        return Function('json_extract', self, path)
+
 
 class Columns(object):
     def __init__(self, name, slots):
@@ -689,16 +1495,19 @@ class Columns(object):
         return '<{} for {} ({})>'.format(self.__class__.__name__, self._name, ', '.join(self._slots))
 
     def __getattr__(self, name):
-        d = {k: v for k, v in _get_all_slots(self._class, include_private=True)}
+        d = dict(_get_all_slots(self._class, include_private=True))
         if name not in d:
             raise AttributeError(name)
 
-        return Column(self._class, name, d[name])
+        # Columns never change, so later lookups find it without calling __getattr__()
+        column = Column(self._class, name, d[name])
+        setattr(self, name, column)
+        return column
 
 
 def model_init(self, *args, **kwargs):
-    slots = list(_get_all_slots(self.__class__, include_private=True))
-    unmatched_kwargs = set(kwargs.keys()).difference(set(key for key, type_ in slots))
+    slots = _get_all_slots(self.__class__, include_private=True)
+    unmatched_kwargs = set(kwargs.keys()).difference(key for key, type_ in slots)
     if unmatched_kwargs:
         raise KeyError('Invalid keyword argument(s): %r' % unmatched_kwargs)
 
@@ -716,10 +1525,6 @@ def model_init(self, *args, **kwargs):
 
 
 class MetaModel(type):
-    @classmethod
-    def __prepare__(metacls, name, bases):
-        return collections.OrderedDict()
-
     def __new__(mcs, name, bases, d):
         # Redirect __init__() to __minidb_init__()
         if '__init__' in d:
@@ -729,33 +1534,56 @@ class MetaModel(type):
         # Caching of live objects
         d['__minidb_cache__'] = weakref.WeakValueDictionary()
 
-        slots = collections.OrderedDict((k, v) for k, v in d.items()
-                                        if k.lower() == k and
-                                        not k.startswith('__') and
-                                        not isinstance(v, types.FunctionType) and
-                                        not isinstance(v, property) and
-                                        not isinstance(v, staticmethod) and
-                                        not isinstance(v, classmethod))
+        # Resolved late-binding column lambdas (see _late_bind())
+        d['__minidb_late_bound__'] = {}
 
-        keep = collections.OrderedDict((k, v) for k, v in d.items() if k not in slots)
+        # The class namespace is a dict, so the columns keep their definition order
+        slots = {k: v for k, v in d.items()
+                 if k.lower() == k and
+                 not k.startswith('__') and
+                 not isinstance(v, types.FunctionType) and
+                 not isinstance(v, property) and
+                 not isinstance(v, staticmethod) and
+                 not isinstance(v, classmethod)}
+
+        keep = {k: v for k, v in d.items() if k not in slots}
         keep['__minidb_slots__'] = slots
 
         keep['__slots__'] = tuple(slots.keys())
         if not bases:
-            # Add weakref slot to Model (for caching)
-            keep['__slots__'] += ('__weakref__',)
+            # Add weakref slot to Model (for caching) and the serialized
+            # values of the last load or save (for smartupdate)
+            keep['__slots__'] += ('__weakref__', '__minidb_stored__')
 
         columns = Columns(name, slots)
         keep['c'] = columns
 
         result = type.__new__(mcs, name, bases, keep)
         columns._class = result
+
+        # Slots of this class and all its bases, in base-to-subclass order
+        all_slots = tuple((name, type_) for clazz in reversed(result.__mro__)
+                          if '__minidb_slots__' in clazz.__dict__
+                          for name, type_ in clazz.__minidb_slots__.items())
+        result.__minidb_all_slots__ = all_slots
+        result.__minidb_columns__ = tuple((name, type_) for name, type_ in all_slots if not name.startswith('_'))
+
+        result.__init__ = _make_init(result)
+        _MODELS.add(result)
+
+        # Generate __repr__() unless the class (or a base class) has a custom one
+        if '__repr__' not in keep and (not bases or getattr(result.__repr__, '__minidb_generated__', False)):
+            result.__repr__ = _make_repr(result)
+
         return result
 
 
-def pformat(result, color=False):
+def pformat(result, color=False, file=None):
+    # Only use colors if the output is meant for a terminal
+    color = color and (file or sys.stdout).isatty()
+
     def incolor(color_id, s):
-        return '\033[9%dm%s\033[0m' % (color_id, s) if sys.stdout.isatty() and color else s
+        return '\033[9%dm%s\033[0m' % (color_id, s) if color else s
 
     inred, ingreen, inyellow, inblue = (functools.partial(incolor, x) for x in range(1, 5))
 
@@ -773,17 +1601,21 @@ def pformat(result, color=False):
 
     s = []
     keys = rows[0].keys()
-    lengths = tuple(max(x) for x in zip(*[[len(str(column)) for column in row] for row in [keys] + rows]))
-    s.append(' | '.join(inyellow('%-{}s'.format(length) % key) for key, length in zip(keys, lengths)))
+    # Each value is converted to a string once, for measuring and for output
+    cells = [[str(column) for column in row] for row in rows]
+    lengths = [len(key) for key in keys]
+    for row in cells:
+        lengths = [max(length, len(cell)) for length, cell in zip(lengths, row)]
+    s.append(' | '.join(inyellow(key.ljust(length)) for key, length in zip(keys, lengths)))
     s.append('-+-'.join('-' * length for length in lengths))
-    for row in rows:
-        s.append(' | '.join(colorvalue('%-{}s'.format(length) % col, col) for col, length in zip(row, lengths)))
+    for row, row_cells in zip(rows, cells):
+        s.append(' | '.join(colorvalue(cell.ljust(length), col) for col, cell, length in zip(row, row_cells, lengths)))
     s.append('({} row(s))'.format(len(rows)))
     return ('\n'.join(s))
 
 
-def pprint(result, color=False):
-    print(pformat(result, color))
+def pprint(result, color=False, file=None):
+    print(pformat(result, color, file), file=file)
 
 
 class JSON(object):
@@ -802,10 +1634,17 @@ def convert_datetime_datetime(v, serialize):
     '2014-12-13T14:15:00'
     >>> convert_datetime_datetime('2014-12-13T14:15:16', False)
     datetime.datetime(2014, 12, 13, 14, 15, 16)
+    >>> convert_datetime_datetime('2014-12-13T14:15:16.001000', False)
+    datetime.datetime(2014, 12, 13, 14, 15, 16, 1000)
     """
     if serialize:
         return v.isoformat()
     else:
+        try:
+            return datetime.datetime.fromisoformat(v)
+        except ValueError:
+            # Before Python 3.11, fromisoformat() only parses 3 or 6 digit fractions
+            pass
         isoformat, microseconds = (v.rsplit('.', 1) if '.' in v else (v, 0))
         return (datetime.datetime.strptime(isoformat, '%Y-%m-%dT%H:%M:%S') +
                 datetime.timedelta(microseconds=int(microseconds)))
@@ -818,10 +1657,17 @@ def convert_datetime_date(v, serialize):
     '2014-12-13'
     >>> convert_datetime_date('2014-12-13', False)
     datetime.date(2014, 12, 13)
+    >>> convert_datetime_date('2014-1-3', False)
+    datetime.date(2014, 1, 3)
     """
     if serialize:
         return v.isoformat()
     else:
+        try:
+            return datetime.date.fromisoformat(v)
+        except ValueError:
+            # fromisoformat() only parses zero-padded months and days
+            pass
         return datetime.datetime.strptime(v, '%Y-%m-%d').date()
 
 
@@ -836,6 +1682,11 @@ def convert_datetime_time(v, serialize):
     if serialize:
         return v.isoformat()
     else:
+        try:
+            return datetime.time.fromisoformat(v)
+        except ValueError:
+            # Before Python 3.11, fromisoformat() only parses 3 or 6 digit fractions
+            pass
         isoformat, microseconds = (v.rsplit('.', 1) if '.' in v else (v, 0))
         return (datetime.datetime.strptime(isoformat, '%H:%M:%S') +
                 datetime.timedelta(microseconds=int(microseconds))).time()
@@ -850,32 +1701,23 @@ class Model(metaclass=MetaModel):
         if DEBUG_OBJECT_CACHE:
             logger.debug('Finalizing {} id={}'.format(cls.__name__, id))
 
-    def __repr__(self):
-        def get_attrs():
-            for key, type_ in _get_all_slots(self.__class__):
-                yield key, getattr(self, key, None)
-
-        attrs = ['{key}={value!r}'.format(key=key, value=value) for key, value in get_attrs()]
-        return '<%(cls)s(%(attrs)s)>' % {
-            'cls': self.__class__.__name__,
-            'attrs': ', '.join(attrs),
-        }
-
     @classmethod
     def __lookup_single(cls, o):
         if o is None:
             return None
 
         cache = cls.__minidb_cache__
-        if o.id not in cache:
-            if DEBUG_OBJECT_CACHE:
-                logger.debug('Storing id={} in cache {}'.format(o.id, o))
-                weakref.finalize(o, cls._finalize, o.id)
-            cache[o.id] = o
-        else:
+        cached = cache.get(o.id)
+        if cached is not None:
             if DEBUG_OBJECT_CACHE:
                 logger.debug('Getting id={} from cache'.format(o.id))
-        return cache[o.id]
+            return cached
+
+        if DEBUG_OBJECT_CACHE:
+            logger.debug('Storing id={} in cache {}'.format(o.id, o))
+            weakref.finalize(o, cls._finalize, o.id)
+        cache[o.id] = o
+        return o
 
     @classmethod
     def __lookup_cache(cls, objects):
@@ -921,6 +1763,17 @@ class Model(metaclass=MetaModel):
 
         return self
 
+    @classmethod
+    def save_many(cls, db, objects):
+        return db.save_many(cls, objects)
+
+    def update(self, **kwargs):
+        if getattr(self, Store.MINIDB_ATTR) is None:
+            raise ValueError('Needs a db object')
+
+        getattr(self, Store.MINIDB_ATTR).update(self, **kwargs)
+        return self
+
     def delete(self):
         if getattr(self, Store.MINIDB_ATTR) is None:
             raise ValueError('Needs a db object')
@@ -944,6 +1797,10 @@ class Model(metaclass=MetaModel):
     def query(cls, db, select=None, where=None, order_by=None, group_by=None, limit=None):
         return db.query(cls, select=select, where=where, order_by=order_by, group_by=group_by, limit=limit)
 
+    @classmethod
+    def query_one(cls, db, select=None, where=None, order_by=None, group_by=None):
+        return db.query_one(cls, select=select, where=where, order_by=order_by, group_by=group_by)
+
     @classmethod
     def pquery(cls, db, select=None, where=None, order_by=None, group_by=None, limit=None, color=True):
         pprint(db.query(cls, select=select, where=where, order_by=order_by, group_by=group_by, limit=limit), color)
@@ -2,6 +2,10 @@ import concurrent.futures
 import minidb
 import pytest
 import datetime
+import io
+import pickle
+import sqlite3
+import threading
 
 
 class FieldTest(minidb.Model):
@@ -87,6 +91,50 @@ def test_instantiate_fieldtest_from_code():
     assert field_test._private4 is None
 
 
+def test_repr():
+    class Base(minidb.Model):
+        name = str
+        _private = int
+
+    class Derived(Base):
+        value = float
+
+    class CustomRepr(Base):
+        def __repr__(self):
+            return 'custom'
+
+    class DerivedCustomRepr(CustomRepr):
+        value = float
+
+    assert repr(Base(name='a', _private=1)) == "<Base(id=None, name='a')>"
+    assert repr(Derived(name='b', value=1.5)) == "<Derived(id=None, name='b', value=1.5)>"
+    assert repr(CustomRepr()) == repr(DerivedCustomRepr()) == 'custom'
+
+    # Unset columns (e.g. before __init__() ran) do not break repr()
+    assert repr(Base.__new__(Base)) == '<Base(id=None, name=None)>'
+
+
+def test_init_gets_inherited_columns_when_loading():
+    class Base(minidb.Model):
+        name = str
+
+    calls = []
+
+    class Derived(Base):
+        value = int
+
+        def __init__(self, **kwargs):
+            calls.append(kwargs)
+
+    with minidb.Store(debug=True) as db:
+        db.register(Derived)
+        Derived(name='a', value=1).save(db)
+        Derived(value=2).save(db)
+        Derived.__minidb_cache__.clear()
+        assert [o.value for o in Derived.load(db)()] == [1, 2]
+        assert calls == [{'name': 'a'}, {}, {'name': 'a'}, {}]
+
+
 def test_saving_object_stores_id():
     with minidb.Store(debug=True) as db:
         db.register(FieldTest)
@@ -127,8 +175,7 @@ def test_loading_object_returns_new_object_after_reference_drop():
 def test_loading_objects():
     with minidb.Store(debug=True) as db:
         db.register(FieldTest)
-        for i in range(100):
-            FieldTest(i).save(db)
+        FieldTest.save_many(db, [FieldTest(i) for i in range(100)])
 
         assert next(FieldTest.c.id.count('count').query(db)).count == 100
 
@@ -171,6 +218,20 @@ def test_invalid_column_raises_attribute_error():
             HasOnlyColumnX.c.y
 
 
+def test_columns_are_cached_per_class():
+    class Base(minidb.Model):
+        foo = str
+
+    class Derived(Base):
+        bar = int
+
+    assert Base.c.foo is Base.c.foo
+    assert Derived.c.foo is not Base.c.foo
+    assert Derived.c.foo.class_ is Derived and Derived.c.bar.type_ is int
+    with pytest.raises(AttributeError):
+        Base.c.bar
+
+
 def test_json_serialization():
     class WithJsonField(minidb.Model):
         foo = str
@@ -205,6 +266,41 @@ def test_json_field_renamed_query():
         assert next(WithJsonField.c.bar('renamed').query(db)).renamed == d
 
 
+def test_json_field_extract_query():
+    class WithJsonField(minidb.Model):
+        foo = str
+        bar = minidb.JSON
+
+    with minidb.Store(debug=True) as db:
+        db.register(WithJsonField)
+        WithJsonField(foo='x', bar={'a': [1, True, 3.9], 'b': 'c'}).save(db)
+        WithJsonField(foo='y', bar={'a': [2], 'b': 'd'}).save(db)
+        assert next(WithJsonField.c.bar['b'].query(db, where=lambda c: c.foo == 'y')) == ('d',)
+        assert next(WithJsonField.c.bar['$.a[0]']('first').query(db, order_by=lambda c: c.id.asc)).first == 1
+        assert [foo for (foo,) in WithJsonField.c.foo.query(db, where=lambda c: c.bar['b'] == 'c')] == ['x']
+
+        # Object keys are quoted, negative indices count from the end of arrays
+        WithJsonField(foo='z', bar={'a.b': 1, 'c d': [4, 5, 6]}).save(db)
+        assert next(WithJsonField.c.bar['a.b'].query(db, where=lambda c: c.foo == 'z')) == (1,)
+        assert next(WithJsonField.c.bar['c d'].query(db, where=lambda c: c.foo == 'z')) == ('[4,5,6]',)
+        assert next(WithJsonField.c.bar['$."c d"[#-1]'].query(db, where=lambda c: c.foo == 'z')) == (6,)
+        WithJsonField(foo='w', bar=[7, 8, 9]).save(db)
+        assert next(WithJsonField.query(db, lambda c: c.bar[0] // c.bar[-1], where=lambda c: c.foo == 'w')) == (7, 9)
+
+        with pytest.raises(TypeError):
+            WithJsonField.c.foo['b']
+        with pytest.raises(TypeError):
+            WithJsonField.c.bar[1.5]
+        with pytest.raises(TypeError):
+            WithJsonField.c.bar[True]
+        with pytest.raises(ValueError):
+            WithJsonField.c.bar['say "hi"']
+        with pytest.raises(TypeError):
+            list(WithJsonField.c.bar)
+        with pytest.raises(TypeError):
+            'a' in WithJsonField.c.bar
+
+
 def test_field_conversion_get_object():
     with minidb.Store(debug=True) as db:
         db.register(FieldConversion)
@@ -328,6 +424,160 @@ def test_delete_where():
         assert {2, 3, 4, 5} == {v for (v,) in DeleteWhere.c.v.query(db)}
 
 
+def test_query_reuse():
+    class Foo(minidb.Model):
+        bar = str
+        baz = int
+
+    query = (Foo.c.baz < 10) & Foo.c.bar.like('a%')
+    sql, args = query.tosql()
+    args.append(123)
+    assert query.tosql() == ('( baz < ? ) AND ( bar LIKE ? )', [10, 'a%'])
+
+    both = minidb.columns(Foo.c.bar, Foo.c.baz)
+    assert (both // Foo.c.id).tosql() == ('bar, baz, id', [])
+    assert both.tosql() == ('bar, baz', [])
+
+
+def test_late_binding_lambdas_are_resolved_once():
+    class Foo(minidb.Model):
+        bar = str
+
+    calls = []
+
+    def where(c):
+        calls.append(c)
+        return c.bar == 'a'
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='a').save(db)
+        Foo(bar='b').save(db)
+        for i in range(3):
+            assert [bar for (bar,) in Foo.c.bar.query(db, where=where)] == ['a']
+            assert [bar for (bar,) in Foo.c.bar.query(db, order_by=lambda c: c.bar.desc)] == ['b', 'a']
+        assert len(calls) == 3
+        assert len(Foo.__minidb_late_bound__) == 1
+
+
+def test_query_one():
+    class Foo(minidb.Model):
+        bar = str
+        baz = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        assert Foo.query_one(db, Foo.c.bar) is None
+        for i in range(3):
+            Foo(bar='x%d' % i, baz=i).save(db)
+        assert Foo.query_one(db, Foo.c.baz.max('highest')).highest == 2
+        assert Foo.query_one(db, lambda c: c.bar // c.baz, order_by=lambda c: c.baz.desc) == ('x2', 2)
+        assert db.count_rows(Foo) == 3
+
+
+def test_long_operation_chain():
+    class Foo(minidb.Model):
+        bar = int
+
+    query = Foo.c.bar == 0
+    for i in range(1, 5000):
+        query = query | (Foo.c.bar == i)
+
+    sql, args = query.tosql()
+    assert args == list(range(5000))
+    assert sql.startswith('( ' * 4999 + 'bar = ? ) OR ( bar = ? ) )')
+
+
+def test_and_or():
+    class Foo(minidb.Model):
+        bar = int
+        baz = str
+
+    any_bar = minidb.or_(*(Foo.c.bar == i for i in range(3)))
+    assert any_bar.tosql() == ('( bar = ? ) OR ( bar = ? ) OR ( bar = ? )', [0, 1, 2])
+    is_a = Foo.c.baz == 'a'
+    assert minidb.and_(is_a) is is_a
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        for i in range(5):
+            Foo(bar=i, baz='even' if i % 2 == 0 else 'odd').save(db)
+
+        assert {foo.bar for foo in Foo.load(db, any_bar)} == {0, 1, 2}
+        assert {foo.bar for foo in Foo.load(db, minidb.and_(any_bar, Foo.c.baz == 'even'))} == {0, 2}
+        assert {foo.bar for foo in Foo.load(db, minidb.and_(Foo.c.bar > 3))} == {4}
+        assert len(list(Foo.load(db, minidb.and_()))) == 5
+        assert list(Foo.load(db, minidb.or_())) == []
+
+
+def test_query_sql_is_reused():
+    class Foo(minidb.Model):
+        bar = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        for i in range(5):
+            Foo(bar=i).save(db)
+
+        where = Foo.c.bar >= 2
+        for limit in (None, 2, 1):
+            expected = [2, 3, 4][:limit]
+            for i in range(2):
+                assert [bar for (bar,) in Foo.query(db, Foo.c.bar, where=where, limit=limit,
+                                                    order_by=lambda c: c.bar.asc)] == expected
+        assert len(db._queries) == 2
+
+        db.QUERY_CACHE_SIZE = 2
+        assert db.query_one(Foo, Foo.c.bar.max)[0] == 4
+        assert len(db._queries) == 1
+
+        # Querying a sequence of columns directly uses the sequence as the cache key
+        both, order_by = Foo.c.id // Foo.c.bar('renamed'), Foo.c.bar.desc
+        for i in range(2):
+            assert [row.renamed for row in both.query(db, order_by=order_by, limit=1)] == [4]
+        assert len(db._queries) == 2
+
+
+def test_late_binding_callables():
+    class Foo(minidb.Model):
+        bar = int
+
+    class Filter(object):
+        def __init__(self, value):
+            self.value = value
+
+        def where(self, c):
+            return c.bar == self.value
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        for i in range(3):
+            Foo(bar=i).save(db)
+
+        assert [foo.bar for foo in Foo.load(db, Filter(1).where)] == [1]
+        assert [bar for (bar,) in Foo.c.bar.query(db, where=Filter(2).where)] == [2]
+        assert db.count_rows(Foo) == 3
+
+
+def test_query_with_in():
+    class InQuery(minidb.Model):
+        v = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(InQuery)
+
+        for i in range(10):
+            InQuery(v=i).save(db)
+
+        assert {1, 3, 5} == {v for (v,) in InQuery.c.v.query(db, where=lambda c: c.v.in_([1, 3, 5, 11]))}
+        assert [] == list(InQuery.c.v.query(db, where=InQuery.c.v.in_([])))
+
+        assert InQuery.c.v.in_([1, 3]).tosql() == ('v IN (?, ?)', [1, 3])
+        assert InQuery.c.v.in_(x for x in [2]).tosql() == ('v IN (?)', [2])
+        assert InQuery.c.v.in_([]).tosql() == ('v IN ()', [])
+        assert repr(InQuery.c.v.in_([1, 3])) == 'InQuery.v IN (1, 3)'
+
+
 def test_invalid_rowproxy_access_by_attribute():
     with pytest.raises(AttributeError):
         class Foo(minidb.Model):
@@ -350,6 +600,37 @@ def test_invalid_rowproxy_access_by_key():
             next(Foo.query(db, Foo.c.bar))['baz']
 
 
+def test_rowproxy_access():
+    class Foo(minidb.Model):
+        bar = str
+        count = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='baz', count=3).save(db)
+        row = next(Foo.query(db, Foo.c.bar // Foo.c.count))
+        assert row == ('baz', 3)
+        assert repr(row) == "('baz', 3)"
+        assert (row.bar, row.count) == (row['bar'], row['count']) == (row[0], row[1])
+        assert dict(row) == {'bar': 'baz', 'count': 3}
+        assert type(row) is type(next(Foo.query(db, Foo.c.bar // Foo.c.count)))
+
+
+def test_rowproxy_pickle():
+    class Foo(minidb.Model):
+        bar = str
+        count = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='baz', count=3).save(db)
+        row = next(Foo.query(db, Foo.c.bar // Foo.c.count))
+        restored = pickle.loads(pickle.dumps(row))
+        assert restored == ('baz', 3)
+        assert (restored.bar, restored['count']) == ('baz', 3)
+        assert type(restored) is type(row)
+
+
 def test_use_schema_without_registration_raises_typeerror():
     with pytest.raises(TypeError):
         with minidb.Store(debug=True) as db:
@@ -442,6 +723,146 @@ def test_update_object():
         assert {'c', 'd'} == {bar for (bar,) in Foo.c.bar.query(db)}
 
 
+def test_smartupdate_object():
+    class Foo(minidb.Model):
+        bar = str
+        baz = int
+
+    statements = []
+    with minidb.Store(debug=True, smartupdate=True) as db:
+        db.register(Foo)
+        a = Foo(bar='a', baz=1).save(db)
+        db.db.set_trace_callback(statements.append)
+
+        a.bar = 'b'
+        a.baz = None
+        a.save()
+        assert next(db.db.execute('SELECT bar, baz FROM Foo')) == ('b', None)
+        assert "UPDATE Foo SET bar='b', baz=NULL WHERE id = 1" in statements
+
+        # Nothing changed, nothing to update
+        del statements[:]
+        a.save()
+        assert not [sql for sql in statements if sql.startswith('UPDATE')]
+
+
+def test_smartupdate_compares_with_stored_values():
+    class Foo(minidb.Model):
+        bar = str
+        payload = minidb.JSON
+
+    statements = []
+    with minidb.Store(debug=True, smartupdate=True) as db:
+        db.register(Foo)
+        a_id = Foo(bar='a', payload={'x': 1}).save(db).id
+        Foo.__minidb_cache__.clear()
+
+        a = Foo.get(db, id=a_id)
+        db.db.set_trace_callback(statements.append)
+
+        # Changes are found without reading the row again, including in-place changes
+        a.payload['x'] = 2
+        a.save()
+        assert not [sql for sql in statements if sql.startswith('SELECT')]
+        assert [sql for sql in statements if sql.startswith('UPDATE')] == [
+            'UPDATE Foo SET payload=\'{"x": 2}\' WHERE id = 1']
+
+        # Columns written by update() are not written again
+        del statements[:]
+        a.update(bar='b')
+        a.save()
+        assert [sql for sql in statements if sql.startswith('UPDATE')] == ["UPDATE Foo SET bar='b' WHERE id = 1"]
+
+        # Objects that were never loaded or saved are compared with the database
+        del statements[:]
+        Foo(id=a_id, bar='c', payload={'x': 2}).save(db)
+        assert [sql for sql in statements if sql.startswith('UPDATE')] == ["UPDATE Foo SET bar='c' WHERE id = 1"]
+        assert next(db.db.execute('SELECT bar, payload FROM Foo')) == ('c', '{"x": 2}')
+
+
+def test_smartupdate_after_rollback():
+    class Foo(minidb.Model):
+        bar = str
+
+    with minidb.Store(debug=True, smartupdate=True) as db:
+        db.register(Foo)
+        a = Foo(bar='a').save(db)
+
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                a.bar = 'b'
+                a.save()
+                raise RuntimeError('rollback')
+        assert next(db.db.execute('SELECT bar FROM Foo')) == ('a',)
+
+        # The values saved in the rolled back transaction are not trusted
+        a.save()
+        assert next(db.db.execute('SELECT bar FROM Foo')) == ('b',)
+
+
+def test_smartupdate_objects_for_the_same_row():
+    class Foo(minidb.Model):
+        bar = str
+
+    with minidb.Store(debug=True, smartupdate=True) as db:
+        db.register(Foo)
+        a_id = Foo(bar='a').save(db).id
+        Foo.__minidb_cache__.clear()
+
+        first = Foo.get(db, id=a_id)
+        Foo.__minidb_cache__.clear()
+        second = Foo.get(db, id=a_id)
+        assert first is not second
+
+        first.bar = 'b'
+        first.save()
+        second.bar = 'a'
+        second.save()
+        assert next(db.db.execute('SELECT bar FROM Foo')) == ('a',)
+
+
+def test_save_without_smartupdate_keeps_no_snapshot():
+    class Foo(minidb.Model):
+        bar = str
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        a = Foo(bar='a').save(db)
+        a.bar = 'b'
+        a.save()
+        assert getattr(a, '__minidb_stored__', None) is None
+
+
+def test_update_columns():
+    class Foo(minidb.Model):
+        bar = str
+        baz = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        a = Foo(bar='a', baz=1).save(db)
+        a_id = a.id
+
+        # Only the given column is written to the database
+        a.bar = 'not saved'
+        a.update(baz='2')
+        assert a.baz == 2 and a.id == a_id
+        assert next(db.db.execute('SELECT bar, baz FROM Foo')) == ('a', 2)
+
+        db.update(a, bar=None)
+        assert a.bar is None
+        assert next(db.db.execute('SELECT bar, baz FROM Foo')) == (None, 2)
+
+        with pytest.raises(KeyError):
+            a.update(id=5)
+
+        with pytest.raises(KeyError):
+            a.update(missing=5)
+
+        with pytest.raises(KeyError):
+            db.update(Foo(bar='unsaved'), bar='x')
+
+
 def test_delete_object():
     class Foo(minidb.Model):
         bar = int
@@ -577,6 +998,29 @@ def test_default_values_with_callable():
     assert f.email == 'joe@example.net'
 
 
+def test_default_values_are_set_on_load():
+    class Foo(minidb.Model):
+        name = str
+        email = str
+        count = int
+        _private = str
+
+        class __minidb_defaults__:
+            email = lambda o: o.name + '@example.com'
+            count = 7
+            _private = 'private'
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(name='Bob', count=3).save(db)
+        db.db.execute('UPDATE Foo SET email = NULL')
+
+        foo = Foo.get(db, name='Bob')
+        assert foo.email == 'Bob@example.com'
+        assert foo.count == 3
+        assert foo._private == 'private'
+
+
 def test_storing_and_retrieving_datetime():
     DT_NOW = datetime.datetime.now()
     D_TODAY = datetime.date.today()
@@ -649,6 +1093,73 @@ def test_custom_converter():
         assert (query_value.position.x, query_value.position.y) == (p.x, p.y)
 
 
+def test_converter_registered_after_model():
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+    class Shape(minidb.Model):
+        pos = Point
+
+    with minidb.Store(debug=True) as db:
+        db.register(Shape)
+
+        @minidb.converter_for(Point)
+        def convert_point(v, serialize):
+            if serialize:
+                return '%d,%d' % (v.x, v.y)
+            else:
+                return Point(*(int(x) for x in v.split(',')))
+
+        shape_id = Shape(pos=Point(1, 2)).save(db).id
+        Shape.__minidb_cache__.clear()
+        pos = Shape.get(db, id=shape_id).pos
+        assert (pos.x, pos.y) == (1, 2)
+        pos, = next(Shape.query(db, Shape.c.pos))
+        assert (pos.x, pos.y) == (1, 2)
+
+
+def test_store_subclass_serialize_is_used():
+    class UpperCaseStore(minidb.Store):
+        def serialize(self, v, t):
+            if isinstance(v, str):
+                return v.upper()
+            return super().serialize(v, t)
+
+    class Foo(minidb.Model):
+        bar = str
+        baz = bool
+
+    with UpperCaseStore(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='abc', baz=True).save(db)
+        assert next(db.db.execute('SELECT bar, baz FROM Foo')) == ('ABC', 1)
+
+
+def test_store_subclass_execute_is_used_without_debug():
+    statements = []
+
+    class RecordingStore(minidb.Store):
+        def _execute(self, sql, args=None):
+            statements.append(sql)
+            return super()._execute(sql, args)
+
+        def _executemany(self, sql, seq_of_args):
+            statements.append(sql)
+            return super()._executemany(sql, seq_of_args)
+
+    class Foo(minidb.Model):
+        bar = str
+
+    with RecordingStore(debug=False) as db:
+        db.register(Foo)
+        del statements[:]
+        Foo(bar='a').save(db)
+        db.save_many(Foo, [Foo(bar='b'), Foo(bar='c')])
+        assert [sql.split()[0] for sql in statements] == ['INSERT', 'INSERT', 'SELECT']
+
+
 def test_delete_all():
     class Thing(minidb.Model):
         bla = str
@@ -665,6 +1176,230 @@ def test_delete_all():
         assert db.count_rows(Thing) == 0
 
 
+def test_save_many():
+    class Thing(minidb.Model):
+        s = str
+        i = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Thing)
+
+        first = Thing(s='first', i=0).save(db)
+        first.i = -1
+
+        things = db.save_many(Thing, [first] + [Thing(s=str(i), i=i) for i in range(1, 10)])
+        assert [thing.id for thing in things] == list(range(1, 11))
+        assert db.count_rows(Thing) == 10
+
+        for thing in things:
+            assert Thing.get(db, id=thing.id) is thing
+
+        expected = {(thing.s, thing.i) for thing in things}
+        assert expected == {tuple(row) for row in Thing.query(db, Thing.c.s // Thing.c.i)}
+
+
+def test_save_many_inserts_many_rows_per_statement():
+    class Thing(minidb.Model):
+        s = str
+        i = int
+
+    statements = []
+    with minidb.Store(debug=True) as db:
+        db.register(Thing)
+        db.MAX_VARIABLES = 6
+        db.db.set_trace_callback(statements.append)
+
+        things = db.save_many(Thing, [Thing(s=str(i), i=i) for i in range(8)])
+        assert [thing.id for thing in things] == list(range(1, 9))
+        assert [thing.i for thing in things] == [i for i, in Thing.c.i.query(db, order_by=Thing.c.id.asc)]
+        assert sum(sql.startswith('INSERT') for sql in statements) == 4
+
+        db.MAX_VARIABLES = 3
+        thing = db.save_many(Thing, [Thing(s='single', i=8)])[0]
+        assert Thing.get(db, id=9) is thing
+
+
+def test_insert_many():
+    class Thing(minidb.Model):
+        s = str
+        i = int
+        d = datetime.date
+
+    with minidb.Store(debug=True) as db:
+        db.register(Thing)
+        db.MAX_VARIABLES = 6
+
+        today = datetime.date.today()
+        assert db.insert_many(Thing, [('a', 1, today), {'s': 'b', 'd': today}, ('c', '3', None)]) == 3
+        assert db.insert_many(Thing, [(10 + i, 'x') for i in range(4)], columns=('id', 's')) == 4
+        assert db.insert_many(Thing, []) == 0
+        assert [(t.id, t.s, t.i, t.d) for t in Thing.load(db)] == [
+            (1, 'a', 1, today), (2, 'b', None, today), (3, 'c', 3, None),
+            (10, 'x', None, None), (11, 'x', None, None), (12, 'x', None, None), (13, 'x', None, None)]
+
+        with pytest.raises(KeyError):
+            db.insert_many(Thing, [(1,)], columns=('missing',))
+        with pytest.raises(ValueError):
+            db.insert_many(Thing, [()], columns=())
+        with pytest.raises(ValueError):
+            db.insert_many(Thing, [{'s': 'd', 'typo': 1}])
+        with pytest.raises(ValueError):
+            db.insert_many(Thing, [{'s': 'd', 'i': 1}], columns=('s',))
+        assert db.count_rows(Thing) == 7
+
+
+def test_save_many_with_wrong_class_raises_typeerror():
+    class Thing(minidb.Model):
+        s = str
+
+    class OtherThing(minidb.Model):
+        s = str
+
+    with pytest.raises(TypeError):
+        with minidb.Store(debug=True) as db:
+            db.register(Thing)
+            db.register(OtherThing)
+            db.save_many(Thing, [Thing(s='a'), OtherThing(s='b')])
+
+
+def test_delete_many():
+    class Foo(minidb.Model):
+        bar = int
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        foos = db.save_many(Foo, [Foo(bar=i) for i in range(10)])
+        db.delete_many(Foo, foos[:5])
+        assert all(foo.id is None for foo in foos[:5])
+        assert sorted(bar for (bar,) in Foo.c.bar.query(db)) == list(range(5, 10))
+        assert Foo.get(db, bar=0) is None
+
+        with pytest.raises(KeyError):
+            db.delete_many(Foo, foos[:1])
+
+        statements = []
+        db.db.set_trace_callback(statements.append)
+        db.MAX_VARIABLES = 2
+        db.delete_many(Foo, foos[5:])
+        assert db.count_rows(Foo) == 0
+        assert sum(sql.startswith('DELETE') for sql in statements) == 3
+
+        with pytest.raises(TypeError):
+            db.delete_many(FieldTest, foos[5:])
+
+
+def test_transaction():
+    class Thing(minidb.Model):
+        s = str
+
+    with minidb.Store(debug=True) as db:
+        db.register(Thing)
+
+        with db.transaction():
+            Thing(s='a').save(db)
+            Thing(s='b').save(db)
+        assert db.count_rows(Thing) == 2
+
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                Thing(s='c').save(db)
+                raise RuntimeError('rollback')
+        assert db.count_rows(Thing) == 2
+
+        # Nested transactions use savepoints
+        with db.transaction():
+            Thing(s='d').save(db)
+            with pytest.raises(RuntimeError):
+                with db.transaction():
+                    Thing(s='e').save(db)
+                    raise RuntimeError('rollback')
+        assert {'a', 'b', 'd'} == {s for (s,) in Thing.c.s.query(db)}
+
+
+def test_transaction_after_save(tmp_path):
+    class Thing(minidb.Model):
+        s = str
+
+    filename = str(tmp_path / 'test.db')
+    with minidb.Store(filename, debug=True, vacuum_on_close=False) as db:
+        db.register(Thing)
+        Thing(s='a').save(db)
+        with db.transaction():
+            Thing(s='b').save(db)
+        assert not db.db.in_transaction
+
+        other = sqlite3.connect(filename)
+        try:
+            assert other.execute('SELECT COUNT(*) FROM Thing').fetchone() == (2,)
+        finally:
+            other.close()
+
+
+def test_file_store_uses_wal(tmp_path):
+    filename = str(tmp_path / 'test.db')
+
+    class Thing(minidb.Model):
+        s = str
+
+    with minidb.Store(filename, debug=True) as db:
+        db.register(Thing)
+        Thing(s='a').save(db)
+        assert next(db.db.execute('PRAGMA journal_mode'))[0] == 'wal'
+        assert next(db.db.execute('PRAGMA cache_size'))[0] == -65536
+
+    with minidb.Store(filename, debug=True) as db:
+        db.register(Thing)
+        assert db.count_rows(Thing) == 1
+
+
+def test_pragmas(tmp_path):
+    pragmas = {'synchronous': 'FULL', 'cache_size': None, 'foreign_keys': 'ON'}
+    with minidb.Store(str(tmp_path / 'test.db'), pragmas=pragmas) as db:
+        assert next(db.db.execute('PRAGMA journal_mode'))[0] == 'wal'
+        assert next(db.db.execute('PRAGMA synchronous'))[0] == 2
+        assert next(db.db.execute('PRAGMA cache_size'))[0] != -65536
+        assert next(db.db.execute('PRAGMA foreign_keys'))[0] == 1
+
+    # In-memory stores only get the given pragmas
+    with minidb.Store(pragmas={'foreign_keys': 'ON'}) as db:
+        assert next(db.db.execute('PRAGMA journal_mode'))[0] == 'memory'
+        assert next(db.db.execute('PRAGMA foreign_keys'))[0] == 1
+
+
+def test_pprint_to_file():
+    class Foo(minidb.Model):
+        bar = str
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='baz').save(db)
+        out = io.StringIO()
+        minidb.pprint(Foo.query(db, Foo.c.bar), file=out)
+        assert out.getvalue() == 'bar\n---\nbaz\n(1 row(s))\n'
+
+
+def test_pprint_color_depends_on_file(monkeypatch):
+    class Foo(minidb.Model):
+        bar = str
+
+    class Terminal(io.StringIO):
+        def isatty(self):
+            return True
+
+    with minidb.Store(debug=True) as db:
+        db.register(Foo)
+        Foo(bar='baz').save(db)
+
+        out = Terminal()
+        minidb.pprint(Foo.query(db, Foo.c.bar), color=True, file=out)
+        assert '\033[' in out.getvalue()
+
+        monkeypatch.setattr('sys.stdout', Terminal())
+        out = io.StringIO()
+        minidb.pprint(Foo.query(db, Foo.c.bar), color=True, file=out)
+        assert out.getvalue() == 'bar\n---\nbaz\n(1 row(s))\n'
+
+
 def test_threaded_query():
     class Thing(minidb.Model):
         s = str
@@ -690,3 +1425,138 @@ def test_threaded_query():
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
         # Wrap in list to resolve all the futures
         list(executor.map(query, range(100)))
+
+
+def test_threaded_load_while_saving():
+    class Thing(minidb.Model):
+        i = int
+
+    with minidb.Store(debug=True, vacuum_on_close=False) as db:
+        db.register(Thing)
+
+        def save(i):
+            return Thing(i=i).save(db).id
+
+        def load(i):
+            return [(thing.id, thing.i) for thing in Thing.load(db, Thing.c.i < i)]
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+        saves = executor.map(save, range(200))
+        loads = executor.map(load, range(200))
+        ids = dict(zip(range(200), saves))
+        assert len(set(ids.values())) == 200
+
+        # Each load sees completely saved rows only, each of them once
+        for i, loaded in enumerate(loads):
+            assert len(loaded) <= i
+            assert len(set(loaded)) == len(loaded)
+            assert all(value < i and ids[value] == id_ for id_, value in loaded)
+        assert db.count_rows(Thing) == 200
+
+
+def test_threaded_load_waits_for_transaction():
+    class Thing(minidb.Model):
+        i = int
+
+    with minidb.Store(debug=True, vacuum_on_close=False) as db:
+        db.register(Thing)
+        saved, rollback = threading.Event(), threading.Event()
+
+        def save():
+            with db.transaction():
+                Thing(i=1).save(db)
+                saved.set()
+                rollback.wait(5)
+                raise RuntimeError('rollback')
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        transaction = executor.submit(save)
+        assert saved.wait(5)
+        load = executor.submit(lambda: len(list(Thing.load(db))))
+        with pytest.raises(concurrent.futures.TimeoutError):
+            load.result(0.1)
+        rollback.set()
+        with pytest.raises(RuntimeError):
+            transaction.result(5)
+        assert load.result(5) == 0
+
+
+def test_transaction_waits_for_running_reads():
+    class Thing(minidb.Model):
+        i = int
+
+    with minidb.Store(debug=True, vacuum_on_close=False) as db:
+        db.register(Thing)
+        started = threading.Event()
+
+        def save():
+            with db.transaction():
+                started.set()
+                Thing(i=1).save(db)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        with db._read_lock:
+            transaction = executor.submit(save)
+            assert not started.wait(0.1)
+        transaction.result(5)
+        assert db.count_rows(Thing) == 1
+
+
+def test_close_vacuums_only_file_stores_with_free_pages(tmp_path):
+    class Thing(minidb.Model):
+        s = str
+
+    statements = []
+
+    db = minidb.Store()
+    db.db.set_trace_callback(statements.append)
+    db.close()
+    assert 'VACUUM' not in statements
+
+    db = minidb.Store(str(tmp_path / 'test.db'))
+    db.register(Thing)
+    db.save_many(Thing, [Thing(s='x' * 1000) for i in range(100)])
+    db.commit()
+    db.db.set_trace_callback(statements.append)
+    db.close()
+    assert 'VACUUM' not in statements
+
+    db = minidb.Store(str(tmp_path / 'test.db'))
+    db.register(Thing)
+    db.delete_where(Thing, Thing.c.id > 50)
+    db.commit()
+    db.db.set_trace_callback(statements.append)
+    db.close(vacuum=False)
+    assert 'VACUUM' not in statements
+
+    db = minidb.Store(str(tmp_path / 'test.db'))
+    db.register(Thing)
+    db.delete_all(Thing)
+    db.commit()
+    db.db.set_trace_callback(statements.append)
+    db.close()
+    assert 'VACUUM' in statements
+
+
+def test_uri_filename(tmp_path):
+    class Thing(minidb.Model):
+        s = str
+
+    with minidb.Store('file:shared_test?mode=memory&cache=shared', debug=True) as db:
+        db.register(Thing)
+        Thing(s='a').save(db)
+        db.commit()
+
+        with minidb.Store('file:shared_test?mode=memory&cache=shared', debug=True) as other:
+            other.register(Thing)
+            assert other.count_rows(Thing) == 1
+
+    filename = tmp_path / 'test.db'
+    with minidb.Store(str(filename), debug=True) as db:
+        db.register(Thing)
+        Thing(s='a').save(db)
+
+    with minidb.Store('file:%s?cache=private' % filename, debug=True) as db:
+        db.register(Thing)
+        assert db.count_rows(Thing) == 1
+        assert next(db.db.execute('PRAGMA journal_mode'))[0] == 'wal'